@@ -1,13 +1,29 @@
 import pandas as pd
+import numpy as np
 import os
-import time
+import asyncio
 import google.generativeai as genai
 from tqdm import tqdm
-import backoff
+from aiolimiter import AsyncLimiter
+import diskcache
+import ahocorasick
 import re
+import json
+import functools
+import logging
+import hashlib
 import random
+import pickle
 from datetime import datetime
 
+# Optional dependencies for the semantic cache
+try:
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
+    SentenceTransformer = None
+
 # Configure Google Gemini API
 GOOGLE_API_KEY = "YOUR_GOOGLE_API_KEY"  # Replace with your actual API key
 genai.configure(api_key=GOOGLE_API_KEY)
@@ -15,20 +31,97 @@ genai.configure(api_key=GOOGLE_API_KEY)
 # Define the model
 model = genai.GenerativeModel('gemini-2.0-flash-001')
 
-# Function to clean and standardize usecase text
-def clean_usecase(text):
-    """Clean and standardize usecase text to contain only symptoms/diseases"""
-    # Remove phrases like "used for", "treatment of", etc.
-    text = re.sub(r'used (in|for|to)|treatment of|indicated for|helps with|treats', '', text, flags=re.IGNORECASE)
+# Token bucket shared by all requests to stay within the API rate limit
+REQUESTS_PER_MINUTE = 60
+limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+# Rate the limiter steps back up to after slowing down, once this many requests in a row succeed
+target_rate = REQUESTS_PER_MINUTE
+RECOVER_AFTER = 20
+successful_requests = 0
+
+# Persistent cache of validated usecases, one entry per medicine, so medicines answered
+# in earlier runs are not paid for again
+response_cache = diskcache.Cache('.gemini_cache')
+
+# Patterns used to clean and validate usecases, compiled once
+# Removes "used for"-style phrases, explanatory phrases, text in parentheses and
+# text that starts with "it" or "this", all in a single pass
+RE_CLEAN = re.compile(
+    r'used (in|for|to)|treatment of|indicated for|helps with|treats'
+    r'|such as|including|like|e\.g\.|i\.e\.'
+    r'|\([^)]*\)'
+    r'|(it|this)( is| can| may| will)?( be| also)? [^,]*,?',
+    re.IGNORECASE
+)
+RE_SENTENCE = re.compile(
+    r'\b(is|are|was|were|will|should|could|would|can|may|might|must|has|have|had|does|do|did)\b'
+    r'|\b(treat|use|help|provide|reduce|prevent|manage|relieve|alleviate)\b',
+    re.IGNORECASE
+)
+# Retry delay suggested in Gemini rate limit errors, e.g. "retry_delay { seconds: 30 }"
+RE_RETRY_DELAY = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)|retry in (\d+(?:\.\d+)?)s', re.IGNORECASE)
+
+class SemanticCache:
+    """Usecases keyed by composition embeddings, so near-identical compositions share one API call"""
+    def __init__(self, path="semantic_cache", threshold=0.93, encoder_name='all-MiniLM-L6-v2', signature=""):
+        self.index_file = f"{path}.index"
+        self.usecases_file = f"{path}.pkl"
+        self.threshold = threshold
+        self.encoder = SentenceTransformer(encoder_name)
+        # Usecases depend on the encoder as well as the model and prompts that produced them
+        self.signature = f"{encoder_name}\n{signature}"
+        self.index = faiss.IndexFlatIP(self.encoder.get_sentence_embedding_dimension())
+        self.usecases = []
+        
+        # Load the cache from a previous run if there is one made with the same signature
+        if os.path.exists(self.index_file) and os.path.exists(self.usecases_file):
+            with open(self.usecases_file, "rb") as f:
+                saved = pickle.load(f)
+            if isinstance(saved, dict) and saved.get('signature') == self.signature:
+                self.index = faiss.read_index(self.index_file)
+                self.usecases = saved['usecases']
+            else:
+                print("Semantic cache was built with a different encoder, model or prompt. Starting a new one.")
     
-    # Remove other explanatory phrases
-    text = re.sub(r'(such as|including|like|e\.g\.|i\.e\.)', '', text, flags=re.IGNORECASE)
+    def embed(self, text):
+        """Embed text as a normalized vector so inner product is cosine similarity"""
+        return self.encoder.encode([text], normalize_embeddings=True).astype('float32')
     
-    # Remove any text in parentheses
-    text = re.sub(r'\([^)]*\)', '', text)
+    def search(self, embedding):
+        """Return the usecase of the most similar cached composition, or None if nothing is close enough"""
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(embedding, 1)
+        if scores[0][0] >= self.threshold:
+            return self.usecases[ids[0][0]]
+        return None
     
-    # Remove any text that starts with "it" or "this"
-    text = re.sub(r'(it|this)( is| can| may| will)?( be| also)? [^,]*,?', '', text, flags=re.IGNORECASE)
+    def add(self, embedding, usecase):
+        """Add a composition embedding and its usecase to the cache"""
+        self.index.add(embedding)
+        self.usecases.append(usecase)
+    
+    def save(self):
+        """Persist the cache so later runs can reuse it"""
+        faiss.write_index(self.index, self.index_file)
+        with open(self.usecases_file, "wb") as f:
+            pickle.dump({'signature': self.signature, 'usecases': self.usecases}, f)
+
+# Semantic cache is only used when faiss and sentence-transformers are installed. It is
+# loaded on first use, so importing this module does not load the encoder.
+semantic_cache = None
+
+def init_semantic_cache():
+    """Load the semantic cache for the current model and prompts, if it is available and not loaded yet"""
+    global semantic_cache
+    if semantic_cache is None and faiss is not None and SentenceTransformer is not None:
+        semantic_cache = SemanticCache(signature=f"{model.model_name}\n{PROMPT_TEMPLATE_HASH}")
+
+# Function to clean and standardize usecase text
+def clean_usecase(text):
+    """Clean and standardize usecase text to contain only symptoms/diseases"""
+    # Remove phrases like "used for", "treatment of", parentheses and "it is ..." sentences
+    text = RE_CLEAN.sub('', text)
     
     # Split by commas and clean each item
     items = [item.strip() for item in text.split(',')]
@@ -44,36 +137,144 @@ def is_rate_limit_error(exception):
     """Check if the exception is due to rate limiting"""
     return "429" in str(exception) or "quota" in str(exception).lower() or "resource exhausted" in str(exception).lower()
 
-# Function to generate usecase with backoff for rate limiting
-@backoff.on_exception(
-    backoff.expo,
-    Exception,
-    max_tries=3,
-    giveup=lambda e: not is_rate_limit_error(e)  # Only retry for rate limit errors
-)
-def get_medicine_usecase(row):
+def get_retry_after(exception):
+    """Get the number of seconds the API asked us to wait before retrying, if it said"""
+    # Retry-After header of the HTTP response, when there is one
+    response = getattr(exception, 'response', None)
+    retry_after = getattr(response, 'headers', None) and response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    
+    # Retry delay included in the error message
+    match = RE_RETRY_DELAY.search(str(exception))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return None
+
+def retry_on_rate_limit(max_tries=3, base_delay=1.0):
+    """Retry a coroutine on rate limit errors using exponential backoff with jitter"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_tries):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    # Only retry for rate limit errors
+                    if not is_rate_limit_error(e) or attempt == max_tries - 1:
+                        raise
+                    delay = get_retry_after(e)
+                    if delay is None:
+                        delay = base_delay * 2 ** attempt + random.uniform(0, base_delay)
+                    # Sleep without blocking the other requests in flight
+                    await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+def change_request_rate(requests_per_minute):
+    """Replace the shared rate limiter with one allowing the given number of requests per minute"""
+    global limiter, successful_requests
+    limiter = AsyncLimiter(requests_per_minute, 60)
+    successful_requests = 0
+
+def set_request_rate(requests_per_minute):
+    """Configure the request rate to use and recover to after rate limiting"""
+    global target_rate
+    target_rate = requests_per_minute
+    change_request_rate(requests_per_minute)
+
+def reset_request_rate():
+    """Go back to the configured request rate"""
+    if limiter.max_rate != target_rate:
+        change_request_rate(target_rate)
+        print(f"Restored request rate to {limiter.max_rate} per minute")
+
+async def generate_text(prompt, **kwargs):
+    """Get the text of a Gemini response, waiting for the rate limiter first"""
+    global successful_requests
+    current_limiter = limiter
+    try:
+        async with current_limiter:
+            response = await model.generate_content_async(prompt, **kwargs)
+    except Exception as e:
+        # The configured rate is more than the API allows, so slow down. Requests that were
+        # already in flight at the old rate only reduce it once.
+        if is_rate_limit_error(e) and current_limiter is limiter and limiter.max_rate > 1:
+            change_request_rate(max(1, int(limiter.max_rate * 0.8)))
+            print(f"\nReduced request rate to {limiter.max_rate} per minute")
+        raise
+    
+    # Step back up towards the configured rate after enough requests in a row succeed
+    if limiter.max_rate < target_rate:
+        successful_requests += 1
+        if successful_requests >= RECOVER_AFTER:
+            change_request_rate(min(target_rate, int(limiter.max_rate * 1.25) + 1))
+            print(f"\nIncreased request rate to {limiter.max_rate} per minute")
+    
+    return response.text
+
+def composition_text(composition1, composition2):
+    """Active components of a medicine as a single string"""
+    return f"{composition1} {composition2 if pd.notna(composition2) else ''}".strip()
+
+# Static parts of the prompts, built once and shared by every request. The rules
+# repeated in both prompts keep the format of the answers the same.
+PROMPT_RULES = """DO NOT write sentences or phrases like "used for", "treats", etc.
+DO NOT provide general categories like "pain relief" - be specific like "headache, joint pain"
+Keep each symptom or disease to 1-3 words when possible.
+"""
+PROMPT_PREFIX = "As a pharmacologist, list ONLY the specific symptoms or diseases treated by this medicine:\n\n"
+PROMPT_SUFFIX = """
+
+Format: Provide ONLY a comma-separated list of specific symptoms or diseases.
+Example good response: "fever, headache, common cold"
+Example bad response: "This medicine is used for treatment of fever and related symptoms."
+
+""" + PROMPT_RULES
+BATCH_PROMPT_PREFIX = "As a pharmacologist, list ONLY the specific symptoms or diseases treated by each of these medicines:\n\n"
+BATCH_PROMPT_SUFFIX = """
+
+Format: Provide ONLY a JSON array with one object per medicine, using the number of the medicine as its id:
+[{"id": 0, "usecase": "fever, headache, common cold"}, {"id": 1, "usecase": "..."}]
+Each usecase must be a comma-separated list of specific symptoms or diseases.
+Example bad usecase: "This medicine is used for treatment of fever and related symptoms."
+
+""" + PROMPT_RULES
+PROMPT_TEMPLATE_HASH = hashlib.sha256((PROMPT_PREFIX + PROMPT_SUFFIX + BATCH_PROMPT_PREFIX + BATCH_PROMPT_SUFFIX).encode()).hexdigest()
+
+def cache_key(name, composition, medicine_type):
+    """Key of a medicine in the response cache, which changes with the model and the prompt templates"""
+    return hashlib.sha256(f"{model.model_name}\n{PROMPT_TEMPLATE_HASH}\n{name}\n{composition}\n{medicine_type}".encode()).hexdigest()
+
+# Function to generate usecase with retries for rate limiting
+@retry_on_rate_limit(max_tries=3)
+async def get_medicine_usecase(name, composition1, composition2, medicine_type):
     """Get usecase for a medicine using Gemini API with proper prompt engineering"""
     try:
-        # Create a structured prompt focused on specific symptoms/diseases
-        prompt = f"""
-        As a pharmacologist, list ONLY the specific symptoms or diseases treated by this medicine:
+        composition = composition_text(composition1, composition2)
         
-        Medicine Name: {row['name']}
-        Active Components: {row['short_composition1']} {row['short_composition2'] if pd.notna(row['short_composition2']) else ''}
-        Medicine Type: {row['type']}
+        # Check the response cache for an answer from an earlier run
+        key = cache_key(name, composition, medicine_type)
+        if key in response_cache:
+            return response_cache[key]
         
-        Format: Provide ONLY a comma-separated list of specific symptoms or diseases.
-        Example good response: "fever, headache, common cold"
-        Example bad response: "This medicine is used for treatment of fever and related symptoms."
+        # Check the semantic cache for a medicine with a near-identical composition
+        if semantic_cache is not None:
+            # Run the encoder in a thread so it doesn't block the other requests in flight
+            embedding = await asyncio.to_thread(semantic_cache.embed, composition)
+            cached = semantic_cache.search(embedding)
+            if cached is not None:
+                return cached
         
-        DO NOT write sentences or phrases like "used for", "treats", etc.
-        DO NOT provide general categories like "pain relief" - be specific like "headache, joint pain"
-        Keep each symptom or disease to 1-3 words when possible.
-        """
+        # Create a structured prompt focused on specific symptoms/diseases
+        prompt = PROMPT_PREFIX + f"Medicine Name: {name}\nActive Components: {composition}\nMedicine Type: {medicine_type}" + PROMPT_SUFFIX
         
         # Get completion from Gemini
-        response = model.generate_content(prompt)
-        usecase = response.text.strip().strip('"\'')
+        response = await generate_text(prompt)
+        usecase = response.strip().strip('"\'')
         
         # Clean and standardize the response
         usecase = clean_usecase(usecase)
@@ -81,6 +282,12 @@ def get_medicine_usecase(row):
         # If after cleaning it's empty, use a fallback
         if not usecase:
             return "unknown"
+        
+        # Only remember usecases that pass validation, so reruns ask again for the rest
+        if validate_usecase(usecase):
+            response_cache.set(key, usecase)
+            if semantic_cache is not None:
+                semantic_cache.add(embedding, usecase)
             
         return usecase
     
@@ -88,12 +295,71 @@ def get_medicine_usecase(row):
         if is_rate_limit_error(e):
             print(f"\nRate limit exceeded at {datetime.now().strftime('%H:%M:%S')}. Waiting before retrying...")
             # Wait for a longer period before retrying - exponential backoff will handle this
-            raise e  # Re-raise to let backoff handle it
+            raise e  # Re-raise to let the retry decorator handle it
         else:
-            print(f"Error processing {row['name']}: {e}")
+            print(f"Error processing {name}: {e}")
             return "unknown"
 
-# Function to validate usecase format
+# Function to generate usecases for several medicines in one request
+@retry_on_rate_limit(max_tries=3)
+async def get_medicine_usecases_batch(medicines):
+    """Get usecases for several medicines with a single Gemini request, sharing the instructions between them"""
+    compositions = [composition_text(composition1, composition2) for _, composition1, composition2, _ in medicines]
+    keys = [cache_key(name, composition, medicine_type) for (name, _, _, medicine_type), composition in zip(medicines, compositions)]
+    embeddings = [None] * len(medicines)
+    
+    # Check the response cache and then the semantic cache first, so only unseen medicines are sent
+    usecases = [response_cache.get(key) for key in keys]
+    if semantic_cache is not None:
+        for i, composition in enumerate(compositions):
+            if usecases[i] is None:
+                # Run the encoder in a thread so it doesn't block the other requests in flight
+                embeddings[i] = await asyncio.to_thread(semantic_cache.embed, composition)
+                usecases[i] = semantic_cache.search(embeddings[i])
+    
+    pending = [i for i, usecase in enumerate(usecases) if usecase is None]
+    if not pending:
+        return usecases
+    
+    try:
+        # Number the medicines so the answers can be matched back to them
+        medicine_list = "\n".join(
+            f"{n}. Medicine Name: {medicines[i][0]} | Active Components: {compositions[i]} | Medicine Type: {medicines[i][3]}"
+            for n, i in enumerate(pending)
+        )
+        prompt = BATCH_PROMPT_PREFIX + medicine_list + BATCH_PROMPT_SUFFIX
+        
+        # Get completion from Gemini as JSON
+        response = await generate_text(prompt, generation_config={"response_mime_type": "application/json"})
+        answers = json.loads(response)
+        
+        # Make sure there is exactly one usecase per medicine
+        if not isinstance(answers, list) or not all(isinstance(a, dict) and isinstance(a.get('usecase'), str) for a in answers):
+            raise ValueError("Unexpected batch response format")
+        answers = {int(a['id']): a['usecase'] for a in answers}
+        if set(answers) != set(range(len(pending))):
+            raise ValueError("Batch response does not match the requested medicines")
+        
+        for n, i in enumerate(pending):
+            # Clean and standardize the response
+            usecase = clean_usecase(answers[n].strip().strip('"\''))
+            usecases[i] = usecase or "unknown"
+            
+            # Only remember usecases that pass validation, so reruns ask again for the rest
+            if usecase and validate_usecase(usecase):
+                response_cache.set(keys[i], usecase)
+                if semantic_cache is not None:
+                    semantic_cache.add(embeddings[i], usecase)
+        
+        return usecases
+    
+    except Exception as e:
+        if is_rate_limit_error(e):
+            print(f"\nRate limit exceeded at {datetime.now().strftime('%H:%M:%S')}. Waiting before retrying...")
+        raise e  # Re-raise to let the retry decorator or the caller handle it
+
+# Function to validate usecase format, cached since the same usecases come up repeatedly
+@functools.lru_cache(maxsize=4096)
 def validate_usecase(usecase):
     """Check if the usecase follows the desired format"""
     # Check if it's too long (likely a sentence)
@@ -101,137 +367,260 @@ def validate_usecase(usecase):
         return False
         
     # Check if it contains verbs that suggest sentences
-    sentence_patterns = [
-        r'\b(is|are|was|were|will|should|could|would|can|may|might|must|has|have|had|does|do|did)\b',
-        r'\b(treat|use|help|provide|reduce|prevent|manage|relieve|alleviate)\b'
-    ]
-    
-    for pattern in sentence_patterns:
-        if re.search(pattern, usecase, re.IGNORECASE):
-            return False
+    if RE_SENTENCE.search(usecase):
+        return False
             
     return True
 
-def process_dataset(input_file, output_file, batch_size=50):
-    """Process the medicine dataset in batches to add usecase field"""
-    # Read the CSV file
-    print(f"Reading dataset from {input_file}...")
-    df = pd.read_csv(input_file)
+def get_progress_logger(log_file):
+    """Get a logger that writes progress messages to the log file"""
+    logger = logging.getLogger("medicine_usecase")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
     
-    # Check if Usecase column already exists
+    # Only attach the file handler once, even if processing runs several times
+    if not any(isinstance(h, logging.FileHandler) and h.baseFilename == os.path.abspath(log_file) for h in logger.handlers):
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+    return logger
+
+def close_progress_logger(logger):
+    """Detach and close the log file handlers of the progress logger"""
+    for handler in [h for h in logger.handlers if isinstance(h, logging.FileHandler)]:
+        logger.removeHandler(handler)
+        handler.close()
+
+def ensure_usecase_column(df):
+    """Add the Usecase column if it is missing, stored as an Arrow-backed string column"""
     if 'Usecase' not in df.columns:
-        df['Usecase'] = None
+        df['Usecase'] = pd.Series(pd.NA, index=df.index, dtype='string[pyarrow]')
+    else:
+        df['Usecase'] = df['Usecase'].astype('string[pyarrow]')
+
+def needs_usecase(usecases):
+    """Mask of rows whose usecase is still missing or unknown"""
+    return usecases.isna() | (usecases == '') | (usecases == 'unknown')
+
+def composition_key(df):
+    """Normalized signature of the active components and type of each medicine"""
+    parts = [df[col].fillna('').str.lower().str.split().str.join(' ') for col in ['short_composition1', 'short_composition2', 'type', 'name']]
+    key = parts[0] + '|' + parts[1] + '|' + parts[2]
+    
+    # Without any composition only the name identifies the medicine, so add it to the key
+    # rather than grouping every such medicine together
+    no_composition = (parts[0] == '') & (parts[1] == '')
+    return key.where(~no_composition, key + '|' + parts[3])
+
+def apply_results(df, results_dict, key_groups):
+    """Write results into the dataframe, copying each one to every row with the same composition"""
+    rows, values = [], []
+    for k, v in results_dict.items():
+        group = key_groups[df.at[k, '_key']]
+        rows.extend(group)
+        values.extend([v] * len(group))
+    
+    # Single indexed assignment instead of one write per row
+    df.loc[rows, 'Usecase'] = pd.Series(values, index=rows)
+    return rows
+
+def append_progress(df, rows, progress_file):
+    """Append the usecases of newly processed rows to the progress file, with the id and name they belong to"""
+    if len(rows) == 0:
+        return
+    df.loc[rows, ['id', 'name', 'Usecase']].to_csv(progress_file, mode='a', header=not os.path.exists(progress_file), index=False)
+
+def load_progress(df, progress_file):
+    """Apply usecases saved to the progress file by an interrupted run, matched to the medicines by id"""
+    if not os.path.exists(progress_file):
+        return
+    progress = pd.read_csv(progress_file).drop_duplicates('id', keep='last').set_index('id')
+    
+    # Refuse a progress file left over from a different dataset rather than mislabel medicines
+    names = df.drop_duplicates('id').set_index('id')['name'].reindex(progress.index)
+    if not names.astype(str).eq(progress['name'].astype(str)).all():
+        raise ValueError(f"{progress_file} does not match the medicines in the input; delete it to start over")
+    
+    usecases = df['id'].map(progress['Usecase'])
+    found = usecases.notna()
+    df.loc[found, 'Usecase'] = usecases[found]
+    print(f"Resumed {len(progress)} usecases from {progress_file}")
+
+def drop_helper_columns(df):
+    """Remove the internal helper columns, which start with an underscore"""
+    return df.drop(columns=[col for col in df.columns if col.startswith('_')])
+
+def save_dataset(df, output_file):
+    """Save the dataframe without the internal helper columns"""
+    drop_helper_columns(df).to_csv(output_file, index=False)
+
+async def process_dataset_async(input_file, output_file, batch_size=50, medicines_per_request=20, max_concurrency=16, requests_per_minute=REQUESTS_PER_MINUTE):
+    """Process the medicine dataset in batches to add usecase field, sending the requests of each batch concurrently.
+    
+    input_file can be the path of a CSV file or an already loaded dataframe, which is left unchanged.
+    """
+    # Read the CSV file, unless the dataframe is already in memory. Work on a copy of
+    # it, so the helper columns and the Usecase dtype don't leak into the caller's frame.
+    if isinstance(input_file, pd.DataFrame):
+        df = input_file.copy()
+    else:
+        print(f"Reading dataset from {input_file}...")
+        df = pd.read_csv(input_file)
+    
+    # Check if Usecase column already exists
+    ensure_usecase_column(df)
     
     total_rows = len(df)
     print(f"Total medicines in dataset: {total_rows}")
     
+    # Checkpoints only append newly processed rows to a progress file, which is
+    # merged into the output file once processing is complete
+    progress_file = f"{output_file}.progress"
+    load_progress(df, progress_file)
+    
+    # Medicines with the same composition share a usecase, so only the first row of
+    # each group is sent to the API and its result is copied to the rest of the group
+    df['_key'] = composition_key(df)
+    key_groups = df[needs_usecase(df['Usecase'])].groupby('_key', sort=False).groups
+    representatives = pd.Index([group[0] for group in key_groups.values()])
+    print(f"Unique compositions to process: {len(representatives)}")
+    
     # Create a temporary dict to store results
     results_dict = {}
     
-    # Create a log file to track progress
+    # Create a log file to track progress, kept open for the whole run
     log_file = "medicine_usecase_progress.log"
-    with open(log_file, "a") as log:
-        log.write(f"\n--- Processing started at {datetime.now()} ---\n")
-    
-    # Process in batches
-    batch_count = (total_rows + batch_size - 1) // batch_size
+    log = get_progress_logger(log_file)
     
-    for i in tqdm(range(batch_count), desc="Processing batches"):
-        start_idx = i * batch_size
-        end_idx = min(start_idx + batch_size, total_rows)
+    # Single progress bar over all medicines sent to the API, redrawn at most twice a second
+    pbar = tqdm(total=len(representatives), desc="Processing medicines", mininterval=0.5)
+    try:
+        log.info(f"\n--- Processing started at {datetime.now()} ---")
         
-        batch = df.iloc[start_idx:end_idx]
-        rows_to_process = batch[batch['Usecase'].isna() | (batch['Usecase'] == '') | (batch['Usecase'] == 'unknown')].index
+        # Bound the number of in-flight requests and keep within the API rate limit
+        sem = asyncio.Semaphore(max_concurrency)
+        set_request_rate(requests_per_minute)
         
-        if len(rows_to_process) == 0:
-            continue
+        # Load the semantic cache now rather than at import time
+        init_semantic_cache()
         
-        # Log batch start
-        with open(log_file, "a") as log:
-            log.write(f"Starting batch {i+1}/{batch_count} at {datetime.now()}\n")
-            
-        # Add randomized delay between batches to avoid predictable patterns
-        delay = random.uniform(1.5, 5.0)
-        time.sleep(delay)
+        async def request(get_usecase, *args):
+            async with sem:
+                return await get_usecase(*args)
         
-        for idx in tqdm(rows_to_process, desc=f"Batch {i+1}/{batch_count}", leave=False):
-            row = df.loc[idx]
-            
+        async def worker(medicines, pbar):
             try:
-                # Try to get usecase
-                usecase = get_medicine_usecase(row)
+                try:
+                    return await request(get_medicine_usecases_batch, medicines)
+                except Exception as e:
+                    if is_rate_limit_error(e):
+                        raise
+                    # Fall back to one request per medicine if the batch response can't be used
+                    print(f"Batch request failed ({e}), retrying medicines one at a time")
+                    return await asyncio.gather(*[request(get_medicine_usecase, *medicine) for medicine in medicines], return_exceptions=True)
+            finally:
+                pbar.update(len(medicines))
+        
+        # Process in batches, split from the rows still to process so no batch needs
+        # to be filtered again
+        todo_idx = representatives.to_numpy()
+        batch_count = (len(todo_idx) + batch_size - 1) // batch_size
+        batches = np.array_split(todo_idx, batch_count) if batch_count else []
+        
+        # Plain (name, composition1, composition2, type) values of each row to process,
+        # so the loop does not build a Series for every row
+        subset = df.loc[todo_idx, ['name', 'short_composition1', 'short_composition2', 'type']]
+        medicines = dict(zip(todo_idx, subset.itertuples(index=False, name=None)))
+        
+        for i, rows_to_process in enumerate(batches):
+            # Log batch start
+            log.info(f"Starting batch {i+1}/{batch_count} at {datetime.now()}")
+            
+            # Pack several medicines into each request and send the requests concurrently
+            chunks = [rows_to_process[j:j + medicines_per_request] for j in range(0, len(rows_to_process), medicines_per_request)]
+            chunk_results = await asyncio.gather(*[worker([medicines[idx] for idx in chunk], pbar) for chunk in chunks], return_exceptions=True)
+            
+            # A failed request fails every medicine in it
+            results = []
+            for chunk, chunk_result in zip(chunks, chunk_results):
+                results.extend([chunk_result] * len(chunk) if isinstance(chunk_result, Exception) else chunk_result)
+            
+            rate_limited = False
+            for idx, usecase in zip(rows_to_process, results):
+                name = medicines[idx][0]
+                
+                if isinstance(usecase, Exception):
+                    if is_rate_limit_error(usecase):
+                        rate_limited = True
+                    else:
+                        # For other errors, log and continue
+                        print(f"Error processing {name}: {usecase}")
+                        log.info(f"Error processing {name}: {usecase}")
+                    continue
                 
-                # Additional validation
+                # Additional validation, the usecase has already been cleaned
                 if not validate_usecase(usecase):
-                    # If validation fails, try to clean it again
-                    usecase = clean_usecase(usecase)
-                    if not validate_usecase(usecase):
-                        usecase = "unknown"
+                    usecase = "unknown"
                 
                 # Store in dictionary
                 results_dict[idx] = usecase
                 
                 # Log successful processing
-                with open(log_file, "a") as log:
-                    log.write(f"Processed {row['name']}: {usecase}\n")
+                log.info(f"Processed {name}: {usecase}")
+            
+            if rate_limited:
+                # If we got rate limit errors, save progress and wait
+                print(f"\nRate limit hit. Saving progress and waiting...")
+                log.info(f"Rate limit hit at {datetime.now()}, saving progress")
                 
-                # Variable delay between requests
-                time.sleep(random.uniform(0.5, 2.0))
+                # Save current progress
+                append_progress(df, apply_results(df, results_dict, key_groups), progress_file)
+                if semantic_cache is not None:
+                    semantic_cache.save()
                 
-            except Exception as e:
-                if is_rate_limit_error(e):
-                    # If we get a rate limit error, save progress and wait
-                    print(f"\nRate limit hit. Saving progress and waiting...")
-                    with open(log_file, "a") as log:
-                        log.write(f"Rate limit hit at {datetime.now()}, saving progress\n")
-                    
-                    # Save current progress
-                    for k, v in results_dict.items():
-                        df.at[k, 'Usecase'] = v
-                    df.to_csv(output_file, index=False)
-                    
-                    # Wait for a longer time before continuing
-                    long_wait = random.uniform(60, 120)  # Wait 1-2 minutes
-                    print(f"Waiting for {long_wait:.1f} seconds before resuming...")
-                    time.sleep(long_wait)
-                    
-                    # Clear results dict after saving
-                    results_dict = {}
-                else:
-                    # For other errors, log and continue
-                    print(f"Error processing {row['name']}: {e}")
-                    with open(log_file, "a") as log:
-                        log.write(f"Error processing {row['name']}: {e}\n")
-            
-            # Save progress periodically
-            if len(results_dict) >= 20:
-                # Apply updates to dataframe
-                for k, v in results_dict.items():
-                    df.at[k, 'Usecase'] = v
+                # Wait for a longer time before continuing
+                long_wait = random.uniform(60, 120)  # Wait 1-2 minutes
+                print(f"Waiting for {long_wait:.1f} seconds before resuming...")
+                await asyncio.sleep(long_wait)
                 
-                # Save to file
-                df.to_csv(output_file, index=False)
-                print(f"Saved progress to {output_file}")
+                # The quota has had time to refill, so go back to the configured rate
+                reset_request_rate()
                 
                 # Clear results dict after saving
                 results_dict = {}
-        
-        # At the end of each batch, save any remaining results
-        if results_dict:
-            for k, v in results_dict.items():
-                df.at[k, 'Usecase'] = v
-            results_dict = {}
             
-        # Save after each batch
-        df.to_csv(output_file, index=False)
-        print(f"Completed batch {i+1}/{batch_count}, saved to {output_file}")
+            # At the end of each batch, save any remaining results
+            if results_dict:
+                append_progress(df, apply_results(df, results_dict, key_groups), progress_file)
+                results_dict = {}
+            
+            pbar.set_postfix_str(f"batch {i+1}/{batch_count}", refresh=False)
+            
+            # Log batch completion
+            log.info(f"Completed batch {i+1}/{batch_count} at {datetime.now()}")
         
-        # Log batch completion
-        with open(log_file, "a") as log:
-            log.write(f"Completed batch {i+1}/{batch_count} at {datetime.now()}\n")
-    
-    print(f"Processing complete. Enhanced dataset saved to {output_file}")
-    return df
+        # Finish the progress bar before printing anything else
+        pbar.close()
+        
+        # Write the complete dataset once and drop the progress file it replaces
+        save_dataset(df, output_file)
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
+        
+        print(f"Processing complete. Enhanced dataset saved to {output_file}")
+        return drop_helper_columns(df)
+    finally:
+        # Close the progress bar and the log file even if processing fails. The semantic
+        # cache is rewritten in full when saved, so it is only saved here and while
+        # waiting out a rate limit rather than after every batch.
+        pbar.close()
+        close_progress_logger(log)
+        if semantic_cache is not None:
+            semantic_cache.save()
+
+def process_dataset(input_file, output_file, batch_size=50, medicines_per_request=20, max_concurrency=16, requests_per_minute=REQUESTS_PER_MINUTE):
+    """Process the medicine dataset in batches to add usecase field"""
+    return asyncio.run(process_dataset_async(input_file, output_file, batch_size, medicines_per_request, max_concurrency, requests_per_minute))
 
 # Common medicines lookup for fallback
 COMMON_MEDICINE_USECASES = {
@@ -250,49 +639,52 @@ COMMON_MEDICINE_USECASES = {
     "Clavulanic Acid": "bacterial infections"
 }
 
-def get_usecase_from_lookup(medicine_name, compositions):
-    """Try to get usecase from lookup table based on medicine name or compositions"""
-    # Check if the medicine name contains any key from the lookup
-    for key in COMMON_MEDICINE_USECASES:
-        if key.lower() in medicine_name.lower():
-            return COMMON_MEDICINE_USECASES[key]
-    
-    # Check if any composition contains a key from the lookup
-    if compositions:
-        for comp in compositions:
-            if pd.notna(comp) and comp:
-                # Extract the first word (active ingredient)
-                active = comp.split()[0] if comp.split() else ""
-                if active.lower() in COMMON_MEDICINE_USECASES:
-                    return COMMON_MEDICINE_USECASES[active.lower()]
-    
+# Aho-Corasick automaton finding any lookup key in a single scan of the text
+LOOKUP_AUTOMATON = ahocorasick.Automaton()
+for key, usecase in COMMON_MEDICINE_USECASES.items():
+    LOOKUP_AUTOMATON.add_word(key.lower(), usecase)
+LOOKUP_AUTOMATON.make_automaton()
+
+def lookup_usecase(text):
+    """Get the usecase of the first lookup key contained in the lowercase text, or None"""
+    if not isinstance(text, str):
+        return None
+    for _, usecase in LOOKUP_AUTOMATON.iter(text):
+        return usecase
     return None
 
-def process_dataset_with_fallback(input_file, output_file, batch_size=50):
+def process_dataset_with_fallback(input_file, output_file, batch_size=50, medicines_per_request=20, max_concurrency=16, requests_per_minute=REQUESTS_PER_MINUTE):
     """Process the dataset with fallback to common medicines lookup"""
     # Read the CSV file
     print(f"Reading dataset from {input_file}...")
     df = pd.read_csv(input_file)
     
     # Check if Usecase column already exists
-    if 'Usecase' not in df.columns:
-        df['Usecase'] = None
+    ensure_usecase_column(df)
     
     # First pass: try to fill using the lookup table to reduce API calls
     print("First pass: Using lookup table for common medicines...")
-    for idx, row in tqdm(df.iterrows(), total=len(df)):
-        if pd.isna(df.at[idx, 'Usecase']) or df.at[idx, 'Usecase'] == '' or df.at[idx, 'Usecase'] == 'unknown':
-            usecase = get_usecase_from_lookup(row['name'], [row['short_composition1'], row['short_composition2']])
-            if usecase:
-                df.at[idx, 'Usecase'] = usecase
+    # Normalize the matched text once for the whole column instead of per row
+    df['_name_lc'] = df['name'].str.lower()
+    # A column with no values at all loads as float64, so convert to string before splitting
+    df['_comp1_first'] = df['short_composition1'].astype('string').str.split().str[0].str.lower()
+    df['_comp2_first'] = df['short_composition2'].astype('string').str.split().str[0].str.lower()
+    
+    # Match the medicine name first, then fall back to the first word (active ingredient)
+    # of each composition
+    lookup = df['_name_lc'].map(lookup_usecase)
+    lookup = lookup.fillna(df['_comp1_first'].map(lookup_usecase))
+    lookup = lookup.fillna(df['_comp2_first'].map(lookup_usecase))
     
-    # Save progress after first pass
-    df.to_csv(output_file, index=False)
-    print(f"First pass complete. Saved to {output_file}")
+    found = needs_usecase(df['Usecase']) & lookup.notna()
+    df.loc[found, 'Usecase'] = lookup[found]
+    df = drop_helper_columns(df)
+    print(f"First pass complete. Found {found.sum()} medicines in the lookup table")
     
-    # Second pass: use API for remaining medicines
+    # Second pass: use API for remaining medicines, passing the dataframe on directly
+    # instead of saving it and reading it back
     print("Second pass: Using API for remaining medicines...")
-    df = process_dataset(output_file, output_file, batch_size)
+    df = process_dataset(df, output_file, batch_size, medicines_per_request, max_concurrency, requests_per_minute)
     
     return df
 
@@ -307,7 +699,7 @@ if __name__ == "__main__":
         input_file = output_file
     
     # Process the dataset with fallback mechanism
-    enhanced_df = process_dataset_with_fallback(input_file, output_file, batch_size=50)
+    enhanced_df = process_dataset_with_fallback(input_file, output_file, batch_size=50, medicines_per_request=20, max_concurrency=16, requests_per_minute=REQUESTS_PER_MINUTE)
     
     # Print sample of processed data
     print("\nSample of processed data:")